@@ -2,21 +2,43 @@
 Kabbalah Code - Backend API with Supabase
 Deploy to Render.com (free tier)
 Python 3.10+
+
+Environment:
+    TELEGRAM_BOT_TOKEN  Telegram bot token
+    ADMIN_SECRET        Admin secret
+    SUPABASE_URL        Supabase project URL (unset: in-memory storage)
+    SUPABASE_KEY        Supabase API key
+    PREDICTION_SECRET   Key for daily prediction codes (unset: per-process random key)
+    CORS_ORIGINS        Comma-separated browser origins allowed to call the API.
+                        Must include the Mini App frontend origin (the page Telegram
+                        opens, not the API URL), e.g. https://<frontend>.onrender.com.
+                        Required on Render; locally defaults to the Vite dev server.
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Query, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
+from sortedcontainers import SortedList
 from typing import Optional
+from dataclasses import dataclass, field, asdict
+from collections import defaultdict, deque
+from itertools import accumulate
 import os
 from datetime import datetime, date
 import random
 import string
-import hashlib
+import secrets
+import struct
+from math import isqrt
+import hmac
+import orjson
 
 # Supabase (uncomment when credentials ready)
 try:
     from supabase import create_client, Client
+    from postgrest.exceptions import APIError
     SUPABASE_URL = os.getenv("SUPABASE_URL")
     SUPABASE_KEY = os.getenv("SUPABASE_KEY")
     if SUPABASE_URL and SUPABASE_KEY:
@@ -33,26 +55,64 @@ except ImportError:
 app = FastAPI(
     title="Kabbalah Code API",
     version="2.0.0",
-    description="Mystical Web3 rewards platform"
+    description="Mystical Web3 rewards platform",
+    default_response_class=ORJSONResponse
 )
 
-# CORS
+# CORS: explicit origins from CORS_ORIGINS, see module docstring
+CORS_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ORIGINS", "").split(",") if origin.strip()]
+if not CORS_ORIGINS:
+    if os.getenv("RENDER"):  # set by Render on every deploy
+        raise RuntimeError("CORS_ORIGINS must list the frontend origin(s) in production")
+    CORS_ORIGINS = ["http://localhost:5173", "http://127.0.0.1:5173"]
+    print("⚠️  CORS_ORIGINS not set, allowing the local Vite dev server only")
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
 # In-memory fallback storage
-users_memory = {}
-predictions_memory = {}
+users_memory = {}  # telegram_id -> UserState
+leaderboard_memory = SortedList()  # (-points, telegram_id), best first
+referrals_memory = defaultdict(list)  # referrer_id -> direct referral ids
 
 # Environment variables
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 ADMIN_SECRET = os.getenv("ADMIN_SECRET", "KABBALAH_ADMIN_2025")
 
+# Keys the daily prediction digest so verification codes can't be precomputed
+PREDICTION_SECRET = os.getenv("PREDICTION_SECRET", "")
+if PREDICTION_SECRET:
+    PREDICTION_KEY = PREDICTION_SECRET.encode()
+else:
+    PREDICTION_KEY = secrets.token_bytes(32)
+    print("⚠️  PREDICTION_SECRET not set, using a per-process key (codes differ across restarts and workers)")
+
+PREDICTIONS = (
+    "Today the gates of ancient wisdom open. Sephira Chokmah illuminates your path through digital realms.",
+    "Energies of Binah protect your journey. Time for deep meditation on blockchain mysteries.",
+    "Malkuth grants material abundance in the metaverse. Act boldly with your transactions!",
+    "Tiferet harmonizes your endeavors. A day for important decisions in the Web3 space.",
+    "Netzach empowers your creative vision. Share your wisdom with the community.",
+    "Hod brings clarity to complex protocols. Study the ancient codes carefully today.",
+    "Yesod connects you to the foundation. Your network grows stronger.",
+    "Gevurah demands discipline. Review your security and strengthen your defenses."
+)
+
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+# Daily prediction digest input: (user_id, day ordinal) packed as raw bytes
+PREDICTION_SEED = struct.Struct(">qI")  # routes bound telegram_id to its int64 range
+
+# Fortune wheel (in-memory draw; Supabase draws from the spin_prizes table),
+# cumulative weights built once so random.choices skips the rebuild
+PRIZES = (50, 100, 150, 200, 500, 1000)
+PRIZE_CUM_WEIGHTS = tuple(accumulate((30, 25, 20, 15, 8, 2)))
+
 # Models
 class UserOnboard(BaseModel):
     telegram_id: int
@@ -64,58 +124,103 @@ class VerifyCode(BaseModel):
     code: str
     tweet_url: Optional[str] = None
 
+@dataclass(slots=True)
+class UserState:
+    """In-memory user record (validated input arrives as UserOnboard)"""
+    telegram_id: int
+    username: str
+    evm_address: str
+    twitter_username: str
+    level: int = 1
+    xp: int = 0
+    points: int = 0
+    referrer_id: Optional[int] = None
+    created_at: str = field(default_factory=lambda: datetime.now().isoformat())
+
 # Utility Functions
-def generate_mystical_code() -> str:
-    return 'KC' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-
-def generate_prediction() -> dict:
-    predictions = [
-        "Today the gates of ancient wisdom open. Sephira Chokmah illuminates your path through digital realms.",
-        "Energies of Binah protect your journey. Time for deep meditation on blockchain mysteries.",
-        "Malkuth grants material abundance in the metaverse. Act boldly with your transactions!",
-        "Tiferet harmonizes your endeavors. A day for important decisions in the Web3 space.",
-        "Netzach empowers your creative vision. Share your wisdom with the community.",
-        "Hod brings clarity to complex protocols. Study the ancient codes carefully today.",
-        "Yesod connects you to the foundation. Your network grows stronger.",
-        "Gevurah demands discipline. Review your security and strengthen your defenses."
-    ]
+async def run_query(query):
+    """Execute a blocking Supabase query off the event loop"""
+    return await run_in_threadpool(query.execute)
+
+async def run_award_rpc(function: str, params: dict) -> dict:
+    """Call a points-award Postgres function, mapping its RAISEd errors to HTTP errors"""
+    try:
+        result = await run_query(supabase.rpc(function, params))
+    except APIError as e:
+        if e.code != "P0001":  # raise_exception from the function body
+            raise
+        status_code = 404 if e.message == "User not found" else 400
+        raise HTTPException(status_code=status_code, detail=e.message)
+    return result.data[0]
+
+async def request_now() -> datetime:
+    """Clock read once per request, FastAPI caches it across dependants"""
+    return datetime.now()
+
+def generate_mystical_code(seed: bytes) -> str:
+    return 'KC' + ''.join(CODE_ALPHABET[b % len(CODE_ALPHABET)] for b in seed)
+
+def daily_prediction(user_id: int, day: date) -> dict:
+    """Derive a user's prediction for a day; deterministic per key, so it is never stored in memory"""
+    digest = hmac.digest(PREDICTION_KEY, PREDICTION_SEED.pack(user_id, day.toordinal()), "sha256")
     
     return {
-        "text": random.choice(predictions),
-        "image_url": f"https://api.dicebear.com/7.x/shapes/svg?seed={random.randint(1000, 9999)}",
-        "code": generate_mystical_code(),
-        "mystical_hash": hashlib.sha256(str(datetime.now()).encode()).hexdigest()[:16]
+        "text": PREDICTIONS[digest[0] % len(PREDICTIONS)],
+        "image_url": f"https://api.dicebear.com/7.x/shapes/svg?seed={1000 + int.from_bytes(digest[1:3], 'big') % 9000}",
+        "code": generate_mystical_code(digest[8:14]),
+        "mystical_hash": digest[:8].hex()
     }
 
 def calculate_xp_for_level(level: int) -> int:
     return 1000 * level + 500 * (level - 1)
 
+def level_up(level: int, xp: int) -> tuple[int, int]:
+    """Apply every level-up the XP pays for in O(1), return (level, xp)"""
+    # XP needed to clear levels 1..n is sum(1500*k - 500) = 750*n^2 + 250*n
+    total = xp + 750 * (level - 1) ** 2 + 250 * (level - 1)
+    cleared = (isqrt(62500 + 3000 * total) - 250) // 1500
+    return cleared + 1, total - (750 * cleared ** 2 + 250 * cleared)
+
+def get_user_memory(telegram_id: int) -> UserState:
+    """Look up an in-memory user or 404"""
+    user = users_memory.get(telegram_id)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+def add_points_memory(user: UserState, points: int) -> None:
+    """Award points to an in-memory user, keeping the leaderboard index sorted"""
+    leaderboard_memory.remove((-user.points, user.telegram_id))
+    user.points += points
+    user.level, user.xp = level_up(user.level, user.xp + points)
+    leaderboard_memory.add((-user.points, user.telegram_id))
+
 # API Endpoints
+# All handlers stay `async def`: in-memory branches are CPU-only and need no
+# threadpool, Supabase I/O goes through run_query so it never blocks the loop.
+
+# Static bodies, encoded once at import
+ROOT_BODY = orjson.dumps({
+    "service": "Kabbalah Code API",
+    "version": "2.0.0",
+    "status": "operational",
+    "database": "Supabase" if USE_SUPABASE else "In-Memory"
+})
+HEALTH_BODY = orjson.dumps({"status": "healthy", "database": "connected" if USE_SUPABASE else "memory"})
 
 @app.get("/")
 async def root():
-    return {
-        "service": "Kabbalah Code API",
-        "version": "2.0.0",
-        "status": "operational",
-        "database": "Supabase" if USE_SUPABASE else "In-Memory"
-    }
+    return Response(content=ROOT_BODY, media_type="application/json")
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "database": "connected" if USE_SUPABASE else "memory"}
+    return Response(content=HEALTH_BODY, media_type="application/json")
 
 @app.post("/api/auth/onboard")
-async def onboard_user(data: UserOnboard, referrer: Optional[int] = None):
+async def onboard_user(data: UserOnboard, referrer: Optional[int] = None, now: datetime = Depends(request_now)):
     """Onboard new user"""
     
     if USE_SUPABASE:
-        # Check if user exists
-        existing = supabase.table("users").select("*").eq("telegram_id", data.telegram_id).execute()
-        if existing.data:
-            return existing.data[0]
-        
-        # Create new user
         user_data = {
             "telegram_id": data.telegram_id,
             "username": data.username,
@@ -124,70 +229,74 @@ async def onboard_user(data: UserOnboard, referrer: Optional[int] = None):
             "referrer_id": referrer
         }
         
-        result = supabase.table("users").insert(user_data).execute()
-        return result.data[0]
+        # Insert unless the user exists; a duplicate returns no rows
+        result = await run_query(
+            supabase.table("users").upsert(user_data, on_conflict="telegram_id", ignore_duplicates=True)
+        )
+        if result.data:
+            return result.data[0]
+        
+        # Existing user
+        existing = await run_query(supabase.table("users").select("*").eq("telegram_id", data.telegram_id))
+        return existing.data[0]
     else:
         # In-memory fallback
         if data.telegram_id in users_memory:
-            return users_memory[data.telegram_id]
-        
-        user = {
-            "telegram_id": data.telegram_id,
-            "username": data.username,
-            "evm_address": data.evm_address,
-            "twitter_username": data.twitter_username,
-            "level": 1,
-            "xp": 0,
-            "points": 0,
-            "referrer_id": referrer,
-            "created_at": datetime.now().isoformat()
-        }
+            return asdict(users_memory[data.telegram_id])
+        
+        user = UserState(
+            telegram_id=data.telegram_id,
+            username=data.username,
+            evm_address=data.evm_address,
+            twitter_username=data.twitter_username,
+            referrer_id=referrer,
+            created_at=now.isoformat()
+        )
         users_memory[data.telegram_id] = user
-        return user
+        leaderboard_memory.add((0, data.telegram_id))
+        if referrer is not None:
+            referrals_memory[referrer].append(data.telegram_id)
+        return asdict(user)
 
 @app.get("/api/user/profile")
 async def get_profile(telegram_id: int):
     """Get user profile"""
     
     if USE_SUPABASE:
-        result = supabase.table("users").select("*").eq("telegram_id", telegram_id).execute()
+        result = await run_query(supabase.table("users").select("*").eq("telegram_id", telegram_id))
         if not result.data:
             raise HTTPException(status_code=404, detail="User not found")
         
         user = result.data[0]
         
         # Count referrals
-        referrals = supabase.table("users").select("telegram_id").eq("referrer_id", telegram_id).execute()
+        referrals = await run_query(supabase.table("users").select("telegram_id").eq("referrer_id", telegram_id))
         user["referrals"] = len(referrals.data)
         user["xp_to_next"] = calculate_xp_for_level(user["level"])
         
-        return user
+        return ORJSONResponse(user)
     else:
         # In-memory fallback
-        if telegram_id not in users_memory:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        user = users_memory[telegram_id].copy()
-        referrals = sum(1 for u in users_memory.values() if u.get("referrer_id") == telegram_id)
-        user["referrals"] = referrals
+        user = asdict(get_user_memory(telegram_id))
+        user["referrals"] = len(referrals_memory.get(telegram_id, ()))
         user["xp_to_next"] = calculate_xp_for_level(user["level"])
         
-        return user
+        return ORJSONResponse(user)
 
 @app.get("/api/prediction/daily")
-async def get_daily_prediction(telegram_id: int):
+async def get_daily_prediction(telegram_id: int = Query(ge=0, lt=2**63), now: datetime = Depends(request_now)):
     """Get daily prediction"""
     
-    today = date.today()
-    cache_key = f"{telegram_id}_{today}"
+    today = now.date()
     
     if USE_SUPABASE:
         # Check if prediction exists for today
-        result = supabase.table("predictions")\
-            .select("*")\
-            .eq("user_id", telegram_id)\
-            .eq("created_at", str(today))\
-            .execute()
+        result = await run_query(
+            supabase.table("predictions")
+            .select("prediction_text, image_url, verification_code, mystical_hash")
+            .eq("user_id", telegram_id)
+            .eq("created_at", str(today))
+        )
         
         if result.data:
             pred = result.data[0]
@@ -199,221 +308,122 @@ async def get_daily_prediction(telegram_id: int):
             }
         
         # Generate new prediction
-        prediction = generate_prediction()
+        prediction = daily_prediction(telegram_id, today)
         
         # Save to DB
-        supabase.table("predictions").insert({
+        await run_query(supabase.table("predictions").insert({
             "user_id": telegram_id,
             "prediction_text": prediction["text"],
             "image_url": prediction["image_url"],
             "verification_code": prediction["code"],
             "mystical_hash": prediction["mystical_hash"]
-        }).execute()
+        }))
         
         # Update user's last_prediction
-        supabase.table("users")\
-            .update({"last_prediction": datetime.now().isoformat()})\
-            .eq("telegram_id", telegram_id)\
-            .execute()
+        await run_query(
+            supabase.table("users")
+            .update({"last_prediction": now.isoformat()})
+            .eq("telegram_id", telegram_id)
+        )
         
         return prediction
     else:
-        # In-memory fallback
-        if cache_key in predictions_memory:
-            return predictions_memory[cache_key]
-        
-        prediction = generate_prediction()
-        predictions_memory[cache_key] = prediction
-        return prediction
+        # In-memory fallback: deterministic per (user, day), nothing to cache
+        return daily_prediction(telegram_id, today)
 
 @app.post("/api/prediction/verify")
-async def verify_prediction(telegram_id: int, data: VerifyCode):
+async def verify_prediction(
+    data: VerifyCode,
+    telegram_id: int = Query(ge=0, lt=2**63),
+    now: datetime = Depends(request_now)
+):
     """Verify tweet and award points"""
     
-    today = date.today()
-    
     if USE_SUPABASE:
-        # Get today's prediction
-        result = supabase.table("predictions")\
-            .select("*")\
-            .eq("user_id", telegram_id)\
-            .eq("created_at", str(today))\
-            .execute()
-        
-        if not result.data:
-            raise HTTPException(status_code=400, detail="No prediction for today")
-        
-        prediction = result.data[0]
-        
-        if prediction["is_verified"]:
-            raise HTTPException(status_code=400, detail="Already verified today")
-        
-        if data.code != prediction["verification_code"]:
-            raise HTTPException(status_code=400, detail="Invalid verification code")
-        
-        # Mark as verified
-        supabase.table("predictions")\
-            .update({"is_verified": True, "verified_at": datetime.now().isoformat()})\
-            .eq("id", prediction["id"])\
-            .execute()
-        
-        # Get user
-        user_result = supabase.table("users").select("*").eq("telegram_id", telegram_id).execute()
-        user = user_result.data[0]
-        
-        # Award points
-        points = 100
-        new_xp = user["xp"] + points
-        new_points = user["points"] + points
-        new_level = user["level"]
-        
-        # Level up logic
-        xp_needed = calculate_xp_for_level(new_level)
-        while new_xp >= xp_needed:
-            new_level += 1
-            new_xp -= xp_needed
-            xp_needed = calculate_xp_for_level(new_level)
-        
-        # Update user
-        supabase.table("users")\
-            .update({"points": new_points, "xp": new_xp, "level": new_level})\
-            .eq("telegram_id", telegram_id)\
-            .execute()
+        # Verify code and award points in a single transaction
+        award = await run_award_rpc("award_points_and_verify", {"uid": telegram_id, "code": data.code})
         
         return {
             "success": True,
-            "points_earned": points,
-            "new_balance": new_points,
-            "level": new_level
+            "points_earned": award["points_earned"],
+            "new_balance": award["new_balance"],
+            "level": award["new_level"]
         }
     else:
-        # In-memory fallback
-        cache_key = f"{telegram_id}_{today}"
-        if cache_key not in predictions_memory:
-            raise HTTPException(status_code=400, detail="No prediction for today")
-        
-        if data.code != predictions_memory[cache_key]["code"]:
+        # In-memory fallback: re-derive today's code instead of looking it up
+        if data.code != daily_prediction(telegram_id, now.date())["code"]:
             raise HTTPException(status_code=400, detail="Invalid verification code")
         
-        user = users_memory.get(telegram_id, {})
         points = 100
-        user["points"] = user.get("points", 0) + points
-        users_memory[telegram_id] = user
+        user = get_user_memory(telegram_id)
+        add_points_memory(user, points)
         
         return {
             "success": True,
             "points_earned": points,
-            "new_balance": user["points"]
+            "new_balance": user.points,
+            "level": user.level
         }
 
 @app.post("/api/fortune/spin")
 async def spin_fortune(telegram_id: int):
     """Spin the fortune tape"""
     
-    today = date.today()
-    
     if USE_SUPABASE:
-        # Check if already spun today
-        result = supabase.table("spins")\
-            .select("*")\
-            .eq("user_id", telegram_id)\
-            .eq("spun_at", str(today))\
-            .execute()
+        # Check daily limit, draw the prize, save spin and award points in a single transaction
+        award = await run_award_rpc("spin_and_award", {"uid": telegram_id})
         
-        if result.data:
-            raise HTTPException(status_code=400, detail="Already spun today")
-        
-        # Random reward
-        prizes = [50, 100, 150, 200, 500, 1000]
-        weights = [30, 25, 20, 15, 8, 2]
-        points = random.choices(prizes, weights=weights)[0]
-        
-        # Save spin
-        supabase.table("spins").insert({
-            "user_id": telegram_id,
-            "points_won": points
-        }).execute()
-        
-        # Get user
-        user_result = supabase.table("users").select("*").eq("telegram_id", telegram_id).execute()
-        user = user_result.data[0]
-        
-        # Update points
-        new_points = user["points"] + points
-        new_xp = user["xp"] + points
-        new_level = user["level"]
-        
-        xp_needed = calculate_xp_for_level(new_level)
-        while new_xp >= xp_needed:
-            new_level += 1
-            new_xp -= xp_needed
-            xp_needed = calculate_xp_for_level(new_level)
-        
-        supabase.table("users")\
-            .update({
-                "points": new_points,
-                "xp": new_xp,
-                "level": new_level,
-                "last_spin": datetime.now().isoformat()
-            })\
-            .eq("telegram_id", telegram_id)\
-            .execute()
-        
-        return {"points": points, "new_balance": new_points}
+        return {"points": award["points_won"], "new_balance": award["new_balance"]}
     else:
         # In-memory fallback
-        prizes = [50, 100, 150, 200, 500, 1000]
-        points = random.choice(prizes)
+        points = random.choices(PRIZES, cum_weights=PRIZE_CUM_WEIGHTS)[0]
         
-        user = users_memory.get(telegram_id, {})
-        user["points"] = user.get("points", 0) + points
-        users_memory[telegram_id] = user
+        user = get_user_memory(telegram_id)
+        add_points_memory(user, points)
         
-        return {"points": points, "new_balance": user["points"]}
+        return {"points": points, "new_balance": user.points}
 
 @app.get("/api/leaderboard")
 async def get_leaderboard(limit: int = 100):
     """Get top users"""
     
     if USE_SUPABASE:
-        result = supabase.table("users")\
-            .select("telegram_id, username, level, points")\
-            .order("points", desc=True)\
-            .limit(limit)\
-            .execute()
-        
-        return [
+        result = await run_query(
+            supabase.table("users")
+            .select("telegram_id, username, level, points")
+            .order("points", desc=True)
+            .limit(limit)
+        )
+        
+        return ORJSONResponse([
             {**user, "rank": i + 1}
             for i, user in enumerate(result.data)
-        ]
+        ])
     else:
-        # In-memory fallback
-        sorted_users = sorted(
-            users_memory.values(),
-            key=lambda u: u.get("points", 0),
-            reverse=True
-        )[:limit]
+        # In-memory fallback: index is kept sorted on every points update
+        top = [users_memory[telegram_id] for _, telegram_id in leaderboard_memory.islice(0, limit)]
         
-        return [
+        return ORJSONResponse([
             {
-                "telegram_id": u["telegram_id"],
-                "username": u["username"],
-                "level": u.get("level", 1),
-                "points": u.get("points", 0),
+                "telegram_id": u.telegram_id,
+                "username": u.username,
+                "level": u.level,
+                "points": u.points,
                 "rank": i + 1
             }
-            for i, u in enumerate(sorted_users)
-        ]
+            for i, u in enumerate(top)
+        ])
 
 @app.get("/api/tasks")
 async def get_tasks():
     """Get all active tasks"""
     
     if USE_SUPABASE:
-        result = supabase.table("tasks")\
-            .select("*")\
-            .eq("is_active", True)\
-            .execute()
+        result = await run_query(
+            supabase.table("tasks")
+            .select("*")
+            .eq("is_active", True)
+        )
         return result.data
     else:
         # Mock tasks
@@ -428,37 +438,39 @@ async def complete_task(task_id: int, telegram_id: int):
     
     if USE_SUPABASE:
         # Check if already completed
-        result = supabase.table("user_tasks")\
-            .select("*")\
-            .eq("user_id", telegram_id)\
-            .eq("task_id", task_id)\
-            .execute()
+        result = await run_query(
+            supabase.table("user_tasks")
+            .select("task_id")
+            .eq("user_id", telegram_id)
+            .eq("task_id", task_id)
+        )
         
         if result.data:
             raise HTTPException(status_code=400, detail="Task already completed")
         
         # Get task
-        task = supabase.table("tasks").select("*").eq("id", task_id).execute()
+        task = await run_query(supabase.table("tasks").select("points").eq("id", task_id))
         if not task.data:
             raise HTTPException(status_code=404, detail="Task not found")
         
         points = task.data[0]["points"]
         
         # Mark as completed
-        supabase.table("user_tasks").insert({
+        await run_query(supabase.table("user_tasks").insert({
             "user_id": telegram_id,
             "task_id": task_id,
             "points_earned": points
-        }).execute()
+        }))
         
         # Award points
-        user = supabase.table("users").select("*").eq("telegram_id", telegram_id).execute()
+        user = await run_query(supabase.table("users").select("points").eq("telegram_id", telegram_id))
         new_points = user.data[0]["points"] + points
         
-        supabase.table("users")\
-            .update({"points": new_points})\
-            .eq("telegram_id", telegram_id)\
-            .execute()
+        await run_query(
+            supabase.table("users")
+            .update({"points": new_points})
+            .eq("telegram_id", telegram_id)
+        )
         
         return {"success": True, "points_earned": points, "new_balance": new_points}
     else:
@@ -470,40 +482,49 @@ async def get_referral_stats(telegram_id: int):
     
     if USE_SUPABASE:
         # Get direct referrals (level 1)
-        level1 = supabase.table("users").select("telegram_id, points").eq("referrer_id", telegram_id).execute()
+        level1 = await run_query(supabase.table("users").select("telegram_id, points").eq("referrer_id", telegram_id))
         
         level1_ids = [u["telegram_id"] for u in level1.data]
         level1_points = sum(u["points"] for u in level1.data)
         
-        # Get level 2 referrals
+        # Get level 2 referrals (one IN query for the whole tier)
         level2 = []
-        level2_points = 0
         if level1_ids:
-            for ref_id in level1_ids:
-                refs = supabase.table("users").select("telegram_id, points").eq("referrer_id", ref_id).execute()
-                level2.extend(refs.data)
-                level2_points += sum(u["points"] for u in refs.data)
+            refs = await run_query(supabase.table("users").select("telegram_id, points").in_("referrer_id", level1_ids))
+            level2 = refs.data
+        level2_points = sum(u["points"] for u in level2)
         
         # Get level 3 referrals
         level2_ids = [u["telegram_id"] for u in level2]
-        level3_points = 0
+        level3 = []
         if level2_ids:
-            for ref_id in level2_ids:
-                refs = supabase.table("users").select("points").eq("referrer_id", ref_id).execute()
-                level3_points += sum(u["points"] for u in refs.data)
+            refs = await run_query(supabase.table("users").select("points").in_("referrer_id", level2_ids))
+            level3 = refs.data
+        level3_points = sum(u["points"] for u in level3)
         
         return {
             "level1_count": len(level1.data),
             "level2_count": len(level2),
-            "level3_count": len(level2_ids),
+            "level3_count": len(level3),
             "total_earned": int(level1_points * 0.1 + level2_points * 0.05 + level3_points * 0.02)
         }
     else:
+        # In-memory fallback: BFS over the referral tree, three tiers deep
+        counts = [0, 0, 0]
+        points = [0, 0, 0]
+        queue = deque((ref_id, 0) for ref_id in referrals_memory.get(telegram_id, ()))
+        while queue:
+            ref_id, tier = queue.popleft()
+            counts[tier] += 1
+            points[tier] += users_memory[ref_id].points
+            if tier < 2:
+                queue.extend((child_id, tier + 1) for child_id in referrals_memory.get(ref_id, ()))
+        
         return {
-            "level1_count": 0,
-            "level2_count": 0,
-            "level3_count": 0,
-            "total_earned": 0
+            "level1_count": counts[0],
+            "level2_count": counts[1],
+            "level3_count": counts[2],
+            "total_earned": int(points[0] * 0.1 + points[1] * 0.05 + points[2] * 0.02)
         }
 
 if __name__ == "__main__":
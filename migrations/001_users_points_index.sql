@@ -0,0 +1,2 @@
+-- Leaderboard: ORDER BY points DESC LIMIT n walks this index instead of sorting users
+CREATE INDEX IF NOT EXISTS users_points_desc ON users (points DESC);
@@ -0,0 +1,124 @@
+-- Points awards in one round-trip and one transaction.
+-- Errors raised here surface to the API as 400s with the same message.
+
+-- Closed-form level up, mirrors level_up in main.py
+CREATE OR REPLACE FUNCTION level_up(cur_level integer, cur_xp integer, OUT new_level integer, OUT new_xp integer)
+LANGUAGE plpgsql IMMUTABLE
+AS $$
+DECLARE
+    -- XP needed to clear levels 1..n is sum(1500*k - 500) = 750*n^2 + 250*n
+    total bigint := cur_xp + 750::bigint * (cur_level - 1) * (cur_level - 1) + 250 * (cur_level - 1);
+    root bigint := floor(sqrt(62500 + 3000 * total::numeric));
+    cleared bigint := (root - 250) / 1500;
+BEGIN
+    new_level := cleared + 1;
+    new_xp := total - (750 * cleared * cleared + 250 * cleared);
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION award_points_and_verify(uid bigint, code text)
+RETURNS TABLE (points_earned integer, new_balance integer, new_level integer)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    reward CONSTANT integer := 100;
+    pred_id bigint;
+    pred_code text;
+    pred_verified boolean;
+    u_points integer;
+    u_xp integer;
+    u_level integer;
+BEGIN
+    -- Row lock makes two concurrent verifies award only once
+    SELECT p.id, p.verification_code, p.is_verified
+    INTO pred_id, pred_code, pred_verified
+    FROM predictions p
+    WHERE p.user_id = uid AND p.created_at = current_date
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'No prediction for today';
+    END IF;
+    IF pred_verified THEN
+        RAISE EXCEPTION 'Already verified today';
+    END IF;
+    IF pred_code <> code THEN
+        RAISE EXCEPTION 'Invalid verification code';
+    END IF;
+
+    SELECT u.points + reward, u.xp + reward, u.level
+    INTO u_points, u_xp, u_level
+    FROM users u
+    WHERE u.telegram_id = uid
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'User not found';
+    END IF;
+
+    SELECT * INTO u_level, u_xp FROM level_up(u_level, u_xp);
+
+    UPDATE predictions SET is_verified = true, verified_at = now() WHERE id = pred_id;
+    UPDATE users SET points = u_points, xp = u_xp, level = u_level WHERE telegram_id = uid;
+
+    RETURN QUERY SELECT reward, u_points, u_level;
+END;
+$$;
+
+-- Fortune wheel odds, mirrors PRIZES / PRIZE_CUM_WEIGHTS in main.py
+CREATE TABLE IF NOT EXISTS spin_prizes (
+    points integer PRIMARY KEY,
+    weight integer NOT NULL CHECK (weight > 0)
+);
+-- Readable by the API key (spin_and_award runs as the caller), not writable
+ALTER TABLE spin_prizes ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS spin_prizes_read ON spin_prizes;
+CREATE POLICY spin_prizes_read ON spin_prizes FOR SELECT USING (true);
+INSERT INTO spin_prizes (points, weight) VALUES
+    (50, 30), (100, 25), (150, 20), (200, 15), (500, 8), (1000, 2)
+ON CONFLICT (points) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION spin_and_award(uid bigint)
+RETURNS TABLE (points_won integer, new_balance integer, new_level integer)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    prize integer;
+    roll bigint;
+    u_points integer;
+    u_xp integer;
+    u_level integer;
+BEGIN
+    -- Weighted draw: first prize whose cumulative weight exceeds the roll
+    SELECT floor(random() * sum(sp.weight)) INTO roll FROM spin_prizes sp;
+    SELECT p.points INTO prize
+    FROM (SELECT sp.points, sum(sp.weight) OVER (ORDER BY sp.points) AS cum_weight FROM spin_prizes sp) p
+    WHERE p.cum_weight > roll
+    ORDER BY p.cum_weight
+    LIMIT 1;
+
+    -- Lock the user first so concurrent spins serialize on the check below
+    SELECT u.points + prize, u.xp + prize, u.level
+    INTO u_points, u_xp, u_level
+    FROM users u
+    WHERE u.telegram_id = uid
+    FOR UPDATE;
+
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'User not found';
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM spins s WHERE s.user_id = uid AND s.spun_at = current_date) THEN
+        RAISE EXCEPTION 'Already spun today';
+    END IF;
+
+    SELECT * INTO u_level, u_xp FROM level_up(u_level, u_xp);
+
+    INSERT INTO spins (user_id, points_won) VALUES (uid, prize);
+    UPDATE users
+    SET points = u_points, xp = u_xp, level = u_level, last_spin = now()
+    WHERE telegram_id = uid;
+
+    RETURN QUERY SELECT prize, u_points, u_level;
+END;
+$$;
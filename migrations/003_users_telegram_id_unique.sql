@@ -0,0 +1,2 @@
+-- Onboarding upserts with ON CONFLICT (telegram_id), which needs a unique index
+CREATE UNIQUE INDEX IF NOT EXISTS users_telegram_id_key ON users (telegram_id);